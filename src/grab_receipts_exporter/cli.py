@@ -2,17 +2,30 @@ import argparse
 import csv
 import email
 import email.message
+import email.parser
 import email.utils
 import imaplib
 import json
 import os
+import queue
 import re
+import threading
 from datetime import timezone, timedelta
 from html import unescape
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence, TextIO, Tuple
 
 from dotenv import load_dotenv
 
+# Optional speedups (pip install grab-receipts-exporter[speedups]); pure-Python fallbacks are used otherwise.
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Bangkok timezone (UTC+7)
 BANGKOK_TZ = timezone(timedelta(hours=7))
 
@@ -30,32 +43,90 @@ ICLOUD_USER = os.environ.get("ICLOUD_USER")
 ICLOUD_PASS = os.environ.get("ICLOUD_PASS")
 ICLOUD_MAILBOX = os.environ.get("ICLOUD_MAILBOX", "INBOX/Grab")
 
+DEFAULT_FETCH_BATCH_SIZE = 100
+# Upper bound on fetched-but-unparsed messages held in memory
+FETCH_QUEUE_SIZE = 200
+
+# Charsets whose bytes can be appended to a UTF-8 buffer as-is
+_UTF8_COMPATIBLE_CHARSETS = frozenset({"utf-8", "utf8", "us-ascii", "ascii"})
+
+# Reused for every message (same compat32 policy as email.message_from_bytes).
+# Only used from the main thread, which parses while the fetch thread talks to IMAP.
+_BYTES_PARSER = email.parser.BytesParser()
+
+# Precompiled patterns, shared by every email processed in a run.
+
+# Total amount
+_RE_BAHT_TOTAL = re.compile(r"฿\s*([\d,]+(?:\.\d{2})?)")
+_RE_THB_PRE = re.compile(r"THB\s*([\d,]+\.\d{2})")
+_RE_THB_SUF = re.compile(r"([\d,]+\.\d{2})\s*THB")
+_TOTAL_PATTERNS = (_RE_BAHT_TOTAL, _RE_THB_PRE, _RE_THB_SUF)
+
+_RE_ORDER_ID = re.compile(r"A-[A-Z0-9]{10,}")
+
+# HTML stripping
+_RE_STYLE_SCRIPT = re.compile(r"<(style|script)\b[^>]*>.*?</\1\s*>", re.DOTALL | re.IGNORECASE)
+_RE_TAG = re.compile(r"<[^>]+>")
+_RE_WS = re.compile(r"\s+")
+
+# GrabFood metadata
+_RE_RESTAURANT = re.compile(r"สถานที่เริ่มต้นการเดินทาง:\s*(.+?)\s*สถานที่ปลายทาง")
+_RE_DELIVERY_ADDRESS = re.compile(r"สถานที่ปลายทาง:\s*(.+?)\s*โปรไฟล์")
+_RE_FOOD_ITEM = re.compile(r"(\d+)x\s+(.+?)\s+฿\s*([\d,]+)")
+_RE_SUBTOTAL = re.compile(r"ค่าอาหาร\s+฿\s*([\d,]+)")
+_RE_DELIVERY_FEE = re.compile(r"ค่าจัดส่ง\s+฿\s*([\d,]+)")
+_RE_FOOD_PLATFORM_FEE = re.compile(r"(?:คำสั่งซื้อพิเศษ|Platform Fee|Small Order Fee)\s*\d*\s*฿\s*([\d,]+)")
+_RE_FOOD_PAYMENT = re.compile(
+    r"(?:รูปแบบการชำระเงิน|Paid by|Payment)[:\s]*(MasterCard|Visa|Cash|GrabPay|เงินสด)\s*(\d{4})?", re.IGNORECASE
+)
+
+# GrabTransport metadata
+_RE_SERVICE_CLASS = re.compile(r"(GrabCar\s*Premium|Standard\s*\(JustGrab\)|JustGrab|GrabBike)", re.IGNORECASE)
+_RE_DIST_DUR = re.compile(r"([\d.]+)\s*km\s*[•·]\s*(\d+)\s*min")
+_RE_LOC_TIME = re.compile(r"([^⋮]+?)\s+(\d{1,2}:\d{2}[AP]M)")
+_RE_FARE = re.compile(r"(?:Fare|ค่าโดยสาร)\s+(?:฿\s*)?([\d,]+)")
+_RE_TOLL = re.compile(r"Toll\s+(?:฿\s*)?([\d,]+)", re.IGNORECASE)
+_RE_TRANSPORT_PLATFORM_FEE = re.compile(r"Platform Fee\s+(?:฿\s*)?([\d,]+)", re.IGNORECASE)
+_RE_CARD_LAST4 = re.compile(r"(?:Paid by|Payment)[:\s]*(?:.*?)(\d{4})\s*(?:฿|THB)", re.IGNORECASE)
+_RE_TRANSPORT_PAYMENT = re.compile(r"(MasterCard|Visa|Cash|GrabPay)\s*(\d{4})?", re.IGNORECASE)
+
+# GrabTip metadata
+_RE_DRIVER_NAME = re.compile(r"(?:ชื่อผู้ขับ|Driver)[:\s]*(?:\(GB\))?\s*([^\n]+?)(?:\s*ชื่อผู้เดินทาง|$)")
+_RE_TIP_PAYMENT = re.compile(r"(?:ชำระโดย|Paid by|Payment)[:\s]*(MasterCard|Visa|Cash|GrabPay)\s*(\d{4})?", re.IGNORECASE)
+
+# Service type markers
+_RE_TIP_MARKER = re.compile(r"Tips E-Receipt|ทิปเพื่อเป็นกำลังใจ|Grab Tips E-Receipt")
+_RE_TRANSPORT_MARKER = re.compile(r"myteksi\.s3.*?\.amazonaws\.com")
+_RE_FOOD_FALLBACK = re.compile(r"ratingStar%3D|orderID%3D00\d{9}")
+_RE_TRANSPORT_FALLBACK = re.compile(r"(?i)pick.{0,5}up\s+location|drop.{0,5}off\s+location")
+
+# UID in a FETCH response, e.g. b'12 (UID 3456 BODY[] {7890}' or b' UID 3456)' after the literal
+_RE_FETCH_UID = re.compile(rb"UID (\d+)")
+
 
 def get_email_text(msg: email.message.Message) -> str:
     """
     Combine text/plain and text/html into one big string for regex parsing.
+    Parts are accumulated as UTF-8 bytes and decoded once at the end.
     """
-    parts: List[str] = []
-    if msg.is_multipart():
-        for part in msg.walk():
-            ctype = part.get_content_type()
-            if ctype in ("text/plain", "text/html"):
-                try:
-                    payload = part.get_payload(decode=True)
-                    if payload is None:
-                        continue
-                    charset = part.get_content_charset() or "utf-8"
-                    parts.append(payload.decode(charset, errors="replace"))
-                except Exception:
-                    continue
-    else:
-        ctype = msg.get_content_type()
-        if ctype in ("text/plain", "text/html"):
-            payload = msg.get_payload(decode=True)
-            if payload:
-                charset = msg.get_content_charset() or "utf-8"
-                parts.append(payload.decode(charset, errors="replace"))
-    return "\n".join(parts)
+    buf = bytearray()
+    # walk() yields the message itself when it is not multipart
+    for part in msg.walk():
+        if part.get_content_type() not in ("text/plain", "text/html"):
+            continue
+        try:
+            payload = part.get_payload(decode=True)
+            if not payload:
+                continue
+            charset = (part.get_content_charset() or "utf-8").lower()
+            if charset not in _UTF8_COMPATIBLE_CHARSETS:
+                payload = payload.decode(charset, errors="replace").encode("utf-8")
+        except Exception:
+            continue
+        if buf:
+            buf.append(0x0A)  # "\n" between parts
+        buf.extend(payload)
+    return buf.decode("utf-8", errors="replace")
 
 
 def extract_total_amount(body: str) -> Optional[float]:
@@ -66,22 +137,13 @@ def extract_total_amount(body: str) -> Optional[float]:
     - ฿ 1,234 (with comma separator)
     - THB 245.00 (with decimals, less common)
     """
-    patterns = [
-        # Thai Baht symbol - integer or with optional decimals
-        r"฿\s*([\d,]+(?:\.\d{2})?)",
-        # THB prefix with decimals
-        r"THB\s*([\d,]+\.\d{2})",
-        # THB suffix
-        r"([\d,]+\.\d{2})\s*THB",
-    ]
-    for pat in patterns:
-        m = re.search(pat, body)
+    # Thai Baht symbol (integer or with optional decimals), then THB prefix, then THB suffix
+    for pat in _TOTAL_PATTERNS:
+        m = pat.search(body)
         if m:
-            val = m.group(1).replace(",", "")
-            try:
-                return float(val)
-            except ValueError:
-                pass
+            amount = parse_amount(m.group(1))
+            if amount is not None:
+                return amount
     return None
 
 
@@ -92,7 +154,7 @@ def extract_order_id(body: str) -> Optional[str]:
     Examples: A-8Q34JAIGWGQMAV, A-7PPCC7TGW4P8AV
     """
     # Direct pattern match for Grab order IDs
-    m = re.search(r"A-[A-Z0-9]{10,}", body)
+    m = _RE_ORDER_ID.search(body)
     if m:
         return m.group(0)
     return None
@@ -100,65 +162,73 @@ def extract_order_id(body: str) -> Optional[str]:
 
 def strip_html(html: str) -> str:
     """Remove HTML tags but keep text content."""
-    text = re.sub(r"<style[^>]*>.*?</style>", "", html, flags=re.DOTALL | re.IGNORECASE)
-    text = re.sub(r"<[^>]+>", " ", text)
-    text = re.sub(r"\s+", " ", text)
-    return unescape(text)
+    if LexborHTMLParser is not None:
+        # One C-level DOM walk; yields unescaped text and drops scripts and comments too
+        tree = LexborHTMLParser(html)
+        for node in tree.css("style, script"):
+            node.decompose()
+        return _RE_WS.sub(" ", tree.text(separator=" ") or "").strip()
+
+    # Same output as the selectolax path: scripts dropped, entities (e.g. &nbsp;) unescaped before collapsing
+    text = _RE_STYLE_SCRIPT.sub("", html)
+    text = _RE_TAG.sub(" ", text)
+    text = unescape(text)
+    return _RE_WS.sub(" ", text).strip()
 
 
 def parse_amount(val: str) -> Optional[float]:
     """Parse a string amount to float, handling commas."""
     try:
-        return float(val.replace(",", ""))
-    except (ValueError, AttributeError):
+        # Most amounts are below 1,000; only pay for the copy when there is a separator
+        return float(val.replace(",", "") if "," in val else val)
+    except (ValueError, TypeError):
         return None
 
 
-def extract_food_metadata(body: str) -> Dict[str, Any]:
+def extract_food_metadata(text: str) -> Dict[str, Any]:
     """
     Extract metadata from GrabFood receipts.
+    Expects text already passed through strip_html.
     Returns: restaurant, delivery_address, items (flattened), subtotal, delivery_fee, platform_fee, payment_method
     """
-    text = strip_html(body)
     metadata: Dict[str, Any] = {}
 
     # Restaurant name - appears after "สถานที่เริ่มต้นการเดินทาง:" (Thai)
-    m = re.search(r"สถานที่เริ่มต้นการเดินทาง:\s*(.+?)\s*สถานที่ปลายทาง", text)
+    m = _RE_RESTAURANT.search(text)
     if m:
         metadata["restaurant"] = m.group(1).strip()
 
     # Delivery address - appears after "สถานที่ปลายทาง:" (Thai)
-    m = re.search(r"สถานที่ปลายทาง:\s*(.+?)\s*โปรไฟล์", text)
+    m = _RE_DELIVERY_ADDRESS.search(text)
     if m:
         metadata["delivery_address"] = m.group(1).strip()
 
     # Items - pattern: "1x item_name ฿ price" (flattened as "qty x name @ price")
-    items = []
-    for match in re.finditer(r"(\d+)x\s+(.+?)\s+฿\s*([\d,]+)", text):
-        qty = int(match.group(1))
-        name = match.group(2).strip()
-        price = parse_amount(match.group(3))
-        items.append(f"{qty}x {name} @{price}")
+    # findall hands back (qty, name, price) tuples without building a Match per item
+    items = [
+        f"{int(qty)}x {name.strip()} @{parse_amount(price)}"
+        for qty, name, price in _RE_FOOD_ITEM.findall(text)
+    ]
     if items:
         metadata["items"] = "; ".join(items)
 
     # Subtotal (ค่าอาหาร)
-    m = re.search(r"ค่าอาหาร\s+฿\s*([\d,]+)", text)
+    m = _RE_SUBTOTAL.search(text)
     if m:
         metadata["subtotal"] = parse_amount(m.group(1))
 
     # Delivery fee (ค่าจัดส่ง)
-    m = re.search(r"ค่าจัดส่ง\s+฿\s*([\d,]+)", text)
+    m = _RE_DELIVERY_FEE.search(text)
     if m:
         metadata["delivery_fee"] = parse_amount(m.group(1))
 
     # Platform fee (คำสั่งซื้อพิเศษ or small order fee)
-    m = re.search(r"(?:คำสั่งซื้อพิเศษ|Platform Fee|Small Order Fee)\s*\d*\s*฿\s*([\d,]+)", text)
+    m = _RE_FOOD_PLATFORM_FEE.search(text)
     if m:
         metadata["platform_fee"] = parse_amount(m.group(1))
 
     # Payment method
-    m = re.search(r"(?:รูปแบบการชำระเงิน|Paid by|Payment)[:\s]*(MasterCard|Visa|Cash|GrabPay|เงินสด)\s*(\d{4})?", text, re.IGNORECASE)
+    m = _RE_FOOD_PAYMENT.search(text)
     if m:
         method = m.group(1)
         last4 = m.group(2) or ""
@@ -167,56 +237,59 @@ def extract_food_metadata(body: str) -> Dict[str, Any]:
     return metadata
 
 
-def extract_transport_metadata(body: str) -> Dict[str, Any]:
+def extract_transport_metadata(text: str) -> Dict[str, Any]:
     """
     Extract metadata from GrabTransport receipts.
+    Expects text already passed through strip_html.
     Returns: service_class, pickup, dropoff, distance_km, duration_min, fare, toll, platform_fee, payment_method
     """
-    text = strip_html(body)
     metadata: Dict[str, Any] = {}
 
     # Service class - appears at the top (e.g., "GrabCar Premium", "Standard (JustGrab)")
-    m = re.search(r"(GrabCar\s*Premium|Standard\s*\(JustGrab\)|JustGrab|GrabBike)", text, re.IGNORECASE)
+    m = _RE_SERVICE_CLASS.search(text)
     if m:
         metadata["service_class"] = m.group(1).strip()
 
     # Distance and duration - pattern: "17.18 km • 38 mins" or "17 km • 38 min"
-    m = re.search(r"([\d.]+)\s*km\s*[•·]\s*(\d+)\s*min", text)
+    m = _RE_DIST_DUR.search(text)
     if m:
         metadata["distance_km"] = float(m.group(1))
         metadata["duration_min"] = int(m.group(2))
 
     # Pickup and dropoff - format is "Location TIME Location TIME"
     # e.g., "The River Condominium North Tower 8:13AM SCB Park Plaza West (Main Entrance) 8:52AM"
-    locations_times = re.findall(r"([^⋮]+?)\s+(\d{1,2}:\d{2}[AP]M)", text)
-    if len(locations_times) >= 2:
-        metadata["pickup"] = locations_times[0][0].strip()
-        metadata["pickup_time"] = locations_times[0][1]
-        metadata["dropoff"] = locations_times[1][0].strip()
-        metadata["dropoff_time"] = locations_times[1][1]
+    # Only the first two matches are needed, so don't materialize the rest
+    locations_times = _RE_LOC_TIME.finditer(text)
+    pickup = next(locations_times, None)
+    dropoff = next(locations_times, None)
+    if pickup and dropoff:
+        metadata["pickup"] = pickup.group(1).strip()
+        metadata["pickup_time"] = pickup.group(2)
+        metadata["dropoff"] = dropoff.group(1).strip()
+        metadata["dropoff_time"] = dropoff.group(2)
 
     # Fare breakdown
     # Base fare
-    m = re.search(r"(?:Fare|ค่าโดยสาร)\s+(?:฿\s*)?([\d,]+)", text)
+    m = _RE_FARE.search(text)
     if m:
         metadata["fare"] = parse_amount(m.group(1))
 
     # Toll
-    m = re.search(r"Toll\s+(?:฿\s*)?([\d,]+)", text, re.IGNORECASE)
+    m = _RE_TOLL.search(text)
     if m:
         metadata["toll"] = parse_amount(m.group(1))
 
     # Platform fee
-    m = re.search(r"Platform Fee\s+(?:฿\s*)?([\d,]+)", text, re.IGNORECASE)
+    m = _RE_TRANSPORT_PLATFORM_FEE.search(text)
     if m:
         metadata["platform_fee"] = parse_amount(m.group(1))
 
     # Payment method
-    m = re.search(r"(?:Paid by|Payment)[:\s]*(?:.*?)(\d{4})\s*(?:฿|THB)", text, re.IGNORECASE)
+    m = _RE_CARD_LAST4.search(text)
     if m:
         metadata["payment_method"] = f"Card ending {m.group(1)}"
     else:
-        m = re.search(r"(MasterCard|Visa|Cash|GrabPay)\s*(\d{4})?", text, re.IGNORECASE)
+        m = _RE_TRANSPORT_PAYMENT.search(text)
         if m:
             method = m.group(1)
             last4 = m.group(2) or ""
@@ -225,22 +298,22 @@ def extract_transport_metadata(body: str) -> Dict[str, Any]:
     return metadata
 
 
-def extract_tip_metadata(body: str) -> Dict[str, Any]:
+def extract_tip_metadata(text: str) -> Dict[str, Any]:
     """
     Extract metadata from GrabTip receipts.
+    Expects text already passed through strip_html.
     Returns: driver_name, payment_method
     Note: order_id is already in the main CSV row, so not duplicated here.
     """
-    text = strip_html(body)
     metadata: Dict[str, Any] = {}
 
     # Driver name (ชื่อผู้ขับ)
-    m = re.search(r"(?:ชื่อผู้ขับ|Driver)[:\s]*(?:\(GB\))?\s*([^\n]+?)(?:\s*ชื่อผู้เดินทาง|$)", text)
+    m = _RE_DRIVER_NAME.search(text)
     if m:
         metadata["driver_name"] = m.group(1).strip()
 
     # Payment method
-    m = re.search(r"(?:ชำระโดย|Paid by|Payment)[:\s]*(MasterCard|Visa|Cash|GrabPay)\s*(\d{4})?", text, re.IGNORECASE)
+    m = _RE_TIP_PAYMENT.search(text)
     if m:
         method = m.group(1)
         last4 = m.group(2) or ""
@@ -256,38 +329,66 @@ def detect_service_type(body: str) -> str:
     # Check for tip receipt first (has specific markers)
     # Thai: "ทิปเพื่อเป็นกำลังใจ" or "ค่าทิป"
     # English: "Tips E-Receipt" or title contains "Tip"
-    if re.search(r"Tips E-Receipt|ทิปเพื่อเป็นกำลังใจ|Grab Tips E-Receipt", body):
+    if _RE_TIP_MARKER.search(body):
         return "GrabTip"
 
     # Primary markers (100% reliable)
     if "SOURCE_GRABFOOD" in body:
         return "GrabFood"
-    if re.search(r"myteksi\.s3.*?\.amazonaws\.com", body):
+    if _RE_TRANSPORT_MARKER.search(body):
         return "GrabTransport"
 
     # Secondary markers (fallback)
-    if re.search(r"ratingStar%3D|orderID%3D00\d{9}", body):
+    if _RE_FOOD_FALLBACK.search(body):
         return "GrabFood"
-    if re.search(r"(?i)pick.{0,5}up\s+location|drop.{0,5}off\s+location", body):
+    if _RE_TRANSPORT_FALLBACK.search(body):
         return "GrabTransport"
 
     return "Unknown"
 
 
-def extract_metadata(body: str, service_type: str) -> Dict[str, Any]:
+_METADATA_EXTRACTORS = {
+    "GrabFood": extract_food_metadata,
+    "GrabTransport": extract_transport_metadata,
+    "GrabTip": extract_tip_metadata,
+}
+
+
+def extract_metadata(text: str, service_type: str) -> Dict[str, Any]:
     """
-    Extract metadata based on service type.
+    Extract metadata based on service type, from text already passed through strip_html.
     """
-    if service_type == "GrabFood":
-        return extract_food_metadata(body)
-    elif service_type == "GrabTransport":
-        return extract_transport_metadata(body)
-    elif service_type == "GrabTip":
-        return extract_tip_metadata(body)
-    return {}
+    extractor = _METADATA_EXTRACTORS.get(service_type)
+    return extractor(text) if extractor else {}
+
+
+def dump_metadata(metadata: Dict[str, Any]) -> str:
+    """Serialize metadata as compact JSON (non-ASCII kept as-is); empty metadata becomes ""."""
+    if not metadata:
+        return ""
+    if orjson is not None:
+        return orjson.dumps(metadata).decode("utf-8")
+    # Same compact separators as orjson, so the column is identical either way
+    return json.dumps(metadata, ensure_ascii=False, separators=(",", ":"))
 
 
-def parse_email_to_row(uid: int, msg: email.message.Message) -> Dict[str, str]:
+class ReceiptRow(NamedTuple):
+    """One CSV row; field order is the CSV column order."""
+
+    uid: str
+    date: str
+    type: str
+    order_id: str
+    currency: str
+    total_amount: str
+    metadata: str
+
+
+CSV_FIELDNAMES = list(ReceiptRow._fields)
+CSV_BUFFER_SIZE = 1 << 20
+
+
+def parse_email_to_row(uid: int, msg: email.message.Message) -> ReceiptRow:
     """
     Convert one email into a CSV row (all values are strings).
     """
@@ -304,65 +405,92 @@ def parse_email_to_row(uid: int, msg: email.message.Message) -> Dict[str, str]:
     total = extract_total_amount(body_text)
     order_id = extract_order_id(body_text)
     service_type = detect_service_type(body_text)
-    metadata = extract_metadata(body_text, service_type)
-
-    row = {
-        "uid": str(uid),
-        "date": date_iso,
-        "type": service_type,
-        "order_id": order_id or "",
-        "currency": "THB" if total is not None else "",
-        "total_amount": f"{total:.2f}" if total is not None else "",
-        "metadata": json.dumps(metadata, ensure_ascii=False) if metadata else "",
-    }
-    return row
+    # Service markers live in URLs and attributes, so detection above runs on the unstripped HTML;
+    # metadata only needs the visible text, stripped once here (and only for known types).
+    extractor = _METADATA_EXTRACTORS.get(service_type)
+    metadata = extractor(strip_html(body_text)) if extractor else {}
+
+    return ReceiptRow(
+        uid=str(uid),
+        date=date_iso,
+        type=service_type,
+        order_id=order_id or "",
+        currency="THB" if total is not None else "",
+        total_amount=f"{total:.2f}" if total is not None else "",
+        metadata=dump_metadata(metadata),
+    )
 
 
-def load_last_uid(path: str) -> int:
+def load_state(path: str) -> Tuple[int, List[int]]:
+    """
+    Load (last_uid, known_uids) from the state file.
+    last_uid is the highest UID already covered by a mailbox search; known_uids are
+    receipts matched by that search but not yet exported (e.g. after an interrupted run).
+    Legacy state files holding just the last UID are still accepted.
+    """
     if not os.path.exists(path):
-        return 0
+        return 0, []
     try:
         with open(path, "r", encoding="utf-8") as f:
             content = f.read().strip()
-        return int(content) if content else 0
+        if not content:
+            return 0, []
+        if content.isdigit():
+            return int(content), []
+        state = json.loads(content)
+        return int(state.get("last_uid", 0)), sorted(int(u) for u in state.get("known", []))
     except Exception:
-        return 0
+        return 0, []
 
 
-def save_last_uid(path: str, uid: int) -> None:
+def save_state(path: str, last_uid: int, known_grab_uids: List[int]) -> None:
+    """Write the state file atomically: a crash mid-write leaves the previous state intact."""
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(str(uid))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"last_uid": last_uid, "known": sorted(known_grab_uids)}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 
-def ensure_csv_with_header(path: str, fieldnames: List[str]) -> Tuple[csv.DictWriter, bool]:
+def ensure_csv_with_header(path: str, fieldnames: List[str]) -> Tuple[Any, TextIO]:
     """
     Open CSV file in append mode, ensure header exists exactly once.
-    Returns (writer, is_new_file).
+    Returns (writer, file); rows are written as tuples in fieldnames order.
+    The caller must close the file via close_csv_writer.
     """
     is_new = not os.path.exists(path) or os.path.getsize(path) == 0
 
-    f = open(path, "a", newline="", encoding="utf-8")
-    writer = csv.DictWriter(f, fieldnames=fieldnames)
+    # Block-buffered: rows reach the OS in 1 MiB chunks; close_csv_writer flushes and fsyncs once
+    f = open(path, "a", newline="", encoding="utf-8", buffering=CSV_BUFFER_SIZE)
+    writer = csv.writer(f)
 
     if is_new:
-        writer.writeheader()
+        writer.writerow(fieldnames)
 
-    # We return writer and leave the file attached (caller must close via writer.writerows + writer.writer)
-    # But we need the underlying file object, so let's attach for convenience.
-    writer._file = f  # type: ignore[attr-defined]
-    return writer, is_new
+    return writer, f
 
 
-def close_csv_writer(writer: csv.DictWriter) -> None:
-    f = getattr(writer, "_file", None)
-    if f is not None:
+def close_csv_writer(f: TextIO) -> None:
+    try:
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
         f.close()
 
 
 def fetch_new_uids(
-    imap: imaplib.IMAP4_SSL, mailbox: str, last_uid: int, subject_filter: Optional[str] = None
+    imap: imaplib.IMAP4_SSL,
+    mailbox: str,
+    last_uid: int,
+    subject_filter: Optional[str] = None,
+    known_uids: Sequence[int] = (),
 ) -> List[int]:
+    """
+    Return the UIDs to export: known_uids (already matched by an earlier search, so not
+    searched again) plus the UIDs above last_uid that match subject_filter.
+    """
     typ, _ = imap.select(f'"{mailbox}"', readonly=True)
     if typ != "OK":
         raise RuntimeError(f"Could not select mailbox {mailbox!r}")
@@ -384,13 +512,97 @@ def fetch_new_uids(
     if typ != "OK":
         raise RuntimeError("IMAP UID SEARCH failed")
 
-    if not data or not data[0]:
-        return []
-
-    uids = [int(u) for u in data[0].split() if u]
+    uids = set(known_uids)
+    if data and data[0]:
+        # "UID n:*" always matches the newest message, even when its UID is below n
+        uids.update(u for u in (int(u) for u in data[0].split() if u) if u > last_uid)
     return sorted(uids)
 
 
+def _chunked(items: Sequence[int], size: int) -> Iterator[Sequence[int]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def fetch_raw_messages(imap: imaplib.IMAP4_SSL, uids: Sequence[int]) -> Optional[Dict[int, bytes]]:
+    """
+    Fetch a batch of messages with a single UID FETCH round-trip.
+    Returns a mapping of UID to raw message bytes; UIDs without a body are omitted.
+    Returns None if the FETCH itself failed, or returned a body that can't be matched to its UID.
+    """
+    # PEEK leaves \Seen untouched even if the mailbox is not selected read-only
+    typ, msg_data = imap.uid("FETCH", ",".join(str(u) for u in uids), "(BODY.PEEK[])")
+    if typ != "OK" or not msg_data:
+        log("WARN", f"Failed to fetch UIDs {uids[0]}..{uids[-1]}")
+        return None
+
+    # msg_data interleaves (header, body) tuples with b")" terminators and
+    # can have extra items (e.g., FLAGS from previous fetch)
+    raw_by_uid: Dict[int, bytes] = {}
+    for i, item in enumerate(msg_data):
+        if isinstance(item, tuple) and len(item) >= 2:
+            if isinstance(item[1], bytes) and len(item[1]) > 100:
+                m = _RE_FETCH_UID.search(item[0])
+                if not m and i + 1 < len(msg_data) and isinstance(msg_data[i + 1], bytes):
+                    # The server may send the UID after the literal, e.g. b' UID 3456)'
+                    m = _RE_FETCH_UID.search(msg_data[i + 1])
+                if not m:
+                    log("WARN", f"Could not match fetched bodies to UIDs {uids[0]}..{uids[-1]}")
+                    return None
+                raw_by_uid[int(m.group(1))] = item[1]
+    return raw_by_uid
+
+
+def iter_raw_messages(
+    imap: imaplib.IMAP4_SSL, uids: Sequence[int], batch_size: int
+) -> Iterator[Tuple[int, Optional[bytes]]]:
+    """
+    Yield (uid, raw_bytes) for each UID in order (raw_bytes is None if the body is missing),
+    while a background thread fetches the following batches so network waits overlap parsing.
+    UIDs of a batch that fetch_raw_messages could not return are not yielded at all,
+    so callers can retry them.
+    All IMAP traffic stays on the fetch thread; imaplib connections are not thread-safe.
+    """
+    q: "queue.Queue[Optional[Tuple[int, Optional[bytes]]]]" = queue.Queue(maxsize=FETCH_QUEUE_SIZE)
+    stop = threading.Event()
+    errors: List[BaseException] = []
+
+    def fetch_worker() -> None:
+        try:
+            for batch in _chunked(uids, batch_size):
+                raw_by_uid = fetch_raw_messages(imap, batch)
+                if raw_by_uid is None:
+                    continue
+                for uid in batch:
+                    if stop.is_set():
+                        return
+                    q.put((uid, raw_by_uid.get(uid)))
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            q.put(None)
+
+    fetcher = threading.Thread(target=fetch_worker, name="imap-fetch", daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            yield item
+        if errors:
+            raise errors[0]
+    finally:
+        # Unblock the fetcher if we stopped early, so nothing touches the connection after we return
+        stop.set()
+        while fetcher.is_alive():
+            try:
+                q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        fetcher.join()
+
+
 GRAB_SUBJECT_FILTER = "Your Grab E-Receipt"
 
 
@@ -398,12 +610,15 @@ def process_mailbox_to_csv(
     mailbox: str,
     csv_path: str,
     state_path: str,
+    batch_size: int = DEFAULT_FETCH_BATCH_SIZE,
 ) -> None:
     if not ICLOUD_USER or not ICLOUD_PASS:
         raise SystemExit("Please set ICLOUD_USER and ICLOUD_PASS environment variables.")
 
-    last_uid = load_last_uid(state_path)
+    last_uid, known_uids = load_state(state_path)
     log("INFO", f"Last processed UID: {last_uid}")
+    if known_uids:
+        log("INFO", f"Resuming {len(known_uids)} pending message(s) from an earlier run")
 
     log("INFO", f"Connecting to {IMAP_HOST}...")
     imap = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT)
@@ -411,61 +626,49 @@ def process_mailbox_to_csv(
     log("INFO", "Logged in successfully")
 
     try:
-        uids = fetch_new_uids(imap, mailbox, last_uid, subject_filter=GRAB_SUBJECT_FILTER)
+        uids = fetch_new_uids(
+            imap, mailbox, last_uid, subject_filter=GRAB_SUBJECT_FILTER, known_uids=known_uids
+        )
         if not uids:
             log("INFO", "No new messages.")
             return
 
         log("INFO", f"Found {len(uids)} new message(s) in {mailbox!r}.")
 
-        fieldnames = [
-            "uid",
-            "date",
-            "type",
-            "order_id",
-            "currency",
-            "total_amount",
-            "metadata",
-        ]
-        writer, _ = ensure_csv_with_header(csv_path, fieldnames)
-
-        max_uid = last_uid
+        writer, csv_file = ensure_csv_with_header(csv_path, CSV_FIELDNAMES)
+
+        # Record the matched UIDs up front, so an interrupted run resumes them without searching again
+        searched_uid = max(last_uid, uids[-1])
+        saved_state = (searched_uid, uids)
+        if saved_state != (last_uid, known_uids):
+            save_state(state_path, *saved_state)
+        pending = set(uids)
         processed_count = 0
 
         try:
-            for uid in uids:
-                if uid > max_uid:
-                    max_uid = uid
-
-                typ, msg_data = imap.uid("FETCH", str(uid), "(BODY[])")
-                if typ != "OK" or not msg_data:
-                    log("WARN", f"Failed to fetch UID {uid}")
-                    continue
-
-                # msg_data can have extra items (e.g., FLAGS from previous fetch)
-                # Find the tuple that contains the email body
-                raw_email = None
-                for item in msg_data:
-                    if isinstance(item, tuple) and len(item) >= 2:
-                        if isinstance(item[1], bytes) and len(item[1]) > 100:
-                            raw_email = item[1]
-                            break
+            for uid, raw_email in iter_raw_messages(imap, uids, batch_size):
                 if not raw_email:
                     log("WARN", f"No email body for UID {uid}")
+                    pending.discard(uid)
                     continue
-                msg = email.message_from_bytes(raw_email)
+                msg = _BYTES_PARSER.parsebytes(raw_email)
 
                 row = parse_email_to_row(uid, msg)
                 writer.writerow(row)
                 # Format date for display: "2025-04-24T05:26:59+00:00" -> "2025-04-24 @ 05:26:59"
-                date_display = row['date'][:10] + " @ " + row['date'][11:19] if row['date'] else "unknown"
-                log("INFO", f"UID {uid} | [{date_display}] | {row['type']} | {row['order_id']} | ฿{row['total_amount']}")
+                date_display = row.date[:10] + " @ " + row.date[11:19] if row.date else "unknown"
+                log("INFO", f"UID {uid} | [{date_display}] | {row.type} | {row.order_id} | ฿{row.total_amount}")
                 processed_count += 1
+                pending.discard(uid)
         finally:
-            close_csv_writer(writer)
+            close_csv_writer(csv_file)
+            remaining = sorted(pending)
+            if (searched_uid, remaining) != saved_state:
+                save_state(state_path, searched_uid, remaining)
 
-        save_last_uid(state_path, max_uid)
         log("INFO", f"Exported {processed_count} receipts to {csv_path}")
+        if remaining:
+            log("WARN", f"{len(remaining)} message(s) could not be fetched and will be retried on the next run")
 
     finally:
         try:
@@ -474,6 +677,17 @@ def process_mailbox_to_csv(
             pass
 
 
+def _positive_int(value: str) -> int:
+    """argparse type for options that must be a positive integer."""
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {n}")
+    return n
+
+
 def build_arg_parser() -> argparse.ArgumentParser:
     p = argparse.ArgumentParser(
         description="Export Grab receipts from an iCloud Mail folder to CSV."
@@ -493,6 +707,12 @@ def build_arg_parser() -> argparse.ArgumentParser:
         default="state/last_uid.txt",
         help="Path to state file storing last processed UID (default: state/last_uid.txt)",
     )
+    p.add_argument(
+        "--batch-size",
+        type=_positive_int,
+        default=DEFAULT_FETCH_BATCH_SIZE,
+        help=f"Number of messages fetched per IMAP FETCH command (default: {DEFAULT_FETCH_BATCH_SIZE})",
+    )
     return p
 
 
@@ -506,6 +726,7 @@ def main() -> None:
         mailbox=args.mailbox,
         csv_path=args.csv_path,
         state_path=args.state_path,
+        batch_size=args.batch_size,
     )
 
 
@@ -1,6 +1,13 @@
 """Unit tests for grab_receipts_exporter.cli module."""
 
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+from grab_receipts_exporter import cli
 from grab_receipts_exporter.cli import (
+    get_email_text,
     extract_total_amount,
     extract_order_id,
     strip_html,
@@ -10,9 +17,35 @@ from grab_receipts_exporter.cli import (
     extract_transport_metadata,
     extract_tip_metadata,
     extract_metadata,
+    fetch_raw_messages,
+    iter_raw_messages,
+    fetch_new_uids,
+    load_state,
+    save_state,
+    parse_email_to_row,
+    ensure_csv_with_header,
+    close_csv_writer,
+    CSV_FIELDNAMES,
+    dump_metadata,
+    build_arg_parser,
 )
 
 
+class TestGetEmailText:
+    """Tests for get_email_text function."""
+
+    def test_joins_text_parts_across_charsets(self):
+        """Test that text parts in different charsets are decoded and joined with newlines."""
+        msg = MIMEMultipart("alternative")
+        msg.attach(MIMEText("ค่าอาหาร ฿ 80", "plain", "utf-8"))
+        msg.attach(MIMEText("<p>café</p>", "html", "iso-8859-1"))
+        assert get_email_text(msg) == "ค่าอาหาร ฿ 80\n<p>café</p>"
+
+    def test_single_part_message(self):
+        """Test a non-multipart message."""
+        assert get_email_text(MIMEText("ชำระโดย Visa 1234", "plain", "utf-8")) == "ชำระโดย Visa 1234"
+
+
 class TestExtractTotalAmount:
     """Tests for extract_total_amount function."""
 
@@ -94,6 +127,18 @@ class TestStripHtml:
         result = strip_html("<p>Hello</p>   <p>World</p>")
         assert "  " not in result  # No double spaces
 
+    def test_selectolax_and_regex_paths_agree(self, monkeypatch):
+        """Test that the selectolax and regex fallback paths produce the same text."""
+        pytest.importorskip("selectolax")
+        html = (
+            "<html><head><style>p { color: red; }</style><script>var x = '<b>';</script></head>"
+            "<body><p>สถานที่เริ่มต้นการเดินทาง: Som&nbsp;Tam</p>\n<p>A &amp; B &lt;C&gt;</p></body></html>"
+        )
+        with_selectolax = strip_html(html)
+        monkeypatch.setattr(cli, "LexborHTMLParser", None)
+        assert strip_html(html) == with_selectolax
+        assert extract_food_metadata(strip_html(html)) == extract_food_metadata(with_selectolax)
+
 
 class TestParseAmount:
     """Tests for parse_amount function."""
@@ -144,6 +189,12 @@ class TestDetectServiceType:
         assert detect_service_type("pick up location: ABC") == "GrabTransport"
         assert detect_service_type("Drop Off Location here") == "GrabTransport"
 
+    def test_grabtransport_secondary_marker_unicode_space(self):
+        """Test that non-ASCII whitespace between words still matches the secondary markers."""
+        assert detect_service_type("Pick up\xa0location") == "GrabTransport"
+        assert detect_service_type("Drop off\u2003location") == "GrabTransport"
+        assert detect_service_type("pick up\u3000location") == "GrabTransport"
+
     def test_unknown_type(self):
         """Test Unknown when no markers found."""
         assert detect_service_type("generic email content") == "Unknown"
@@ -155,6 +206,20 @@ class TestDetectServiceType:
         body = "Tips E-Receipt SOURCE_GRABFOOD"
         assert detect_service_type(body) == "GrabTip"
 
+    def test_priority_independent_of_position(self):
+        """Test that marker priority holds wherever the markers appear in the body."""
+        assert detect_service_type("SOURCE_GRABFOOD ... Tips E-Receipt") == "GrabTip"
+        assert detect_service_type("myteksi.s3.amazonaws.com/x.png SOURCE_GRABFOOD") == "GrabFood"
+        assert detect_service_type("pick up location myteksi.s3.amazonaws.com") == "GrabTransport"
+
+    def test_food_marker_in_encoded_part_beats_plain_transport_marker(self):
+        """Test that food priority holds when only the transport marker is visible in the raw message."""
+        msg = MIMEMultipart("alternative")
+        msg.attach(MIMEText("https://myteksi.s3.ap-southeast-1.amazonaws.com/logo.png", "plain", "us-ascii"))
+        msg.attach(MIMEText("<p>SOURCE_GRABFOOD ร้านอาหาร</p>", "html", "utf-8"))  # base64-encoded
+        assert b"SOURCE_GRABFOOD" not in msg.as_bytes()
+        assert detect_service_type(get_email_text(msg)) == "GrabFood"
+
 
 class TestExtractFoodMetadata:
     """Tests for extract_food_metadata function."""
@@ -191,6 +256,15 @@ class TestExtractFoodMetadata:
         metadata = extract_food_metadata(body)
         assert metadata.get("payment_method") == "MasterCard 1234"
 
+    def test_extracts_all_fee_fields_together(self):
+        """Test that fee fields sharing one body are all extracted, first occurrence wins."""
+        body = "ค่าอาหาร ฿ 260 ค่าจัดส่ง ฿ 36 Small Order Fee ฿ 15 Paid by Visa 4321 ค่าอาหาร ฿ 999"
+        metadata = extract_food_metadata(body)
+        assert metadata.get("subtotal") == 260.0
+        assert metadata.get("delivery_fee") == 36.0
+        assert metadata.get("platform_fee") == 15.0
+        assert metadata.get("payment_method") == "Visa 4321"
+
 
 class TestExtractTransportMetadata:
     """Tests for extract_transport_metadata function."""
@@ -207,6 +281,15 @@ class TestExtractTransportMetadata:
         assert metadata.get("distance_km") == 17.18
         assert metadata.get("duration_min") == 38
 
+    def test_extracts_pickup_and_dropoff(self):
+        """Test pickup/dropoff extraction from the first two location-time pairs."""
+        body = "The River 8:13AM SCB Park Plaza 8:52AM Receipt sent 9:00AM"
+        metadata = extract_transport_metadata(body)
+        assert metadata.get("pickup") == "The River"
+        assert metadata.get("pickup_time") == "8:13AM"
+        assert metadata.get("dropoff") == "SCB Park Plaza"
+        assert metadata.get("dropoff_time") == "8:52AM"
+
     def test_extracts_fare(self):
         """Test fare extraction."""
         body = "Fare ฿ 556"
@@ -225,6 +308,17 @@ class TestExtractTransportMetadata:
         metadata = extract_transport_metadata(body)
         assert metadata.get("platform_fee") == 20.0
 
+    def test_extracts_fare_breakdown_together(self):
+        """Test that service class, distance and fare breakdown are extracted from one body."""
+        body = "JustGrab 5.2 km • 14 mins Fare ฿ 120 Toll ฿ 25 Platform Fee ฿ 10"
+        metadata = extract_transport_metadata(body)
+        assert metadata.get("service_class") == "JustGrab"
+        assert metadata.get("distance_km") == 5.2
+        assert metadata.get("duration_min") == 14
+        assert metadata.get("fare") == 120.0
+        assert metadata.get("toll") == 25.0
+        assert metadata.get("platform_fee") == 10.0
+
 
 class TestExtractTipMetadata:
     """Tests for extract_tip_metadata function."""
@@ -261,3 +355,232 @@ class TestExtractMetadata:
         """Test that Unknown type returns empty dict."""
         metadata = extract_metadata("some body", "Unknown")
         assert metadata == {}
+
+
+class FakeImap:
+    """Minimal stand-in for imaplib.IMAP4_SSL returning a canned UID FETCH response."""
+
+    def __init__(self, typ, data):
+        self.typ = typ
+        self.data = data
+        self.calls = []
+
+    def uid(self, command, *args):
+        self.calls.append((command,) + args)
+        return self.typ, self.data
+
+
+class FakeBatchImap:
+    """Stand-in for imaplib.IMAP4_SSL serving bodies for whichever UIDs are requested."""
+
+    def __init__(self, bodies, fail_after=None, refused_fetches=()):
+        self.bodies = bodies
+        self.fail_after = fail_after
+        self.refused_fetches = refused_fetches
+        self.fetches = 0
+
+    def uid(self, command, uid_set, spec):
+        if self.fail_after is not None and self.fetches >= self.fail_after:
+            raise OSError("connection reset")
+        self.fetches += 1
+        if self.fetches in self.refused_fetches:
+            return "NO", [None]
+        data = []
+        for i, uid in enumerate(int(u) for u in uid_set.split(",")):
+            if uid in self.bodies:
+                data.append((f"{i + 1} (UID {uid} BODY[] {{0}}".encode(), self.bodies[uid]))
+                data.append(b")")
+        return "OK", data
+
+
+class TestFetchRawMessages:
+    """Tests for fetch_raw_messages function."""
+
+    def test_maps_bodies_to_uids(self):
+        """Test that a bulk FETCH response is split into per-UID bodies."""
+        body_a = b"Subject: A\r\n\r\n" + b"a" * 200
+        body_b = b"Subject: B\r\n\r\n" + b"b" * 200
+        imap = FakeImap("OK", [
+            (b"1 (UID 101 BODY[] {215}", body_a),
+            b")",
+            (b"2 (FLAGS (\\Seen) UID 102 BODY[] {215}", body_b),
+            b")",
+        ])
+        result = fetch_raw_messages(imap, [101, 102, 103])
+        assert result == {101: body_a, 102: body_b}
+        assert imap.calls == [("FETCH", "101,102,103", "(BODY.PEEK[])")]
+
+    def test_uid_after_literal(self):
+        """Test that a UID sent after the body literal is picked up from the following element."""
+        body_a = b"Subject: A\r\n\r\n" + b"a" * 200
+        body_b = b"Subject: B\r\n\r\n" + b"b" * 200
+        imap = FakeImap("OK", [
+            (b"1 (BODY[] {215}", body_a),
+            b" UID 5)",
+            (b"2 (BODY[] {215}", body_b),
+            b" UID 6)",
+        ])
+        assert fetch_raw_messages(imap, [5, 6]) == {5: body_a, 6: body_b}
+
+    def test_body_without_uid_returns_none(self):
+        """Test that a body that can't be matched to a UID fails the batch instead of dropping it."""
+        imap = FakeImap("OK", [(b"1 (BODY[] {215}", b"x" * 200), b")"])
+        assert fetch_raw_messages(imap, [5]) is None
+
+    def test_failed_fetch_returns_none(self):
+        """Test that a failed FETCH is reported as None, not as missing bodies."""
+        assert fetch_raw_messages(FakeImap("NO", [None]), [101]) is None
+
+
+class TestIterRawMessages:
+    """Tests for iter_raw_messages function."""
+
+    def test_yields_every_uid_in_order(self):
+        """Test that all UIDs are yielded in order across batches, None for missing bodies."""
+        bodies = {uid: b"x" * 200 for uid in (1, 2, 4, 5)}
+        imap = FakeBatchImap(bodies)
+        result = list(iter_raw_messages(imap, [1, 2, 3, 4, 5], batch_size=2))
+        assert [uid for uid, _ in result] == [1, 2, 3, 4, 5]
+        assert result[2][1] is None
+        assert imap.fetches == 3
+
+    def test_skips_uids_of_failed_batch(self):
+        """Test that UIDs of a batch whose FETCH was refused are not yielded."""
+        bodies = {uid: b"x" * 200 for uid in (1, 2, 3, 4)}
+        imap = FakeBatchImap(bodies, refused_fetches={2})
+        result = list(iter_raw_messages(imap, [1, 2, 3, 4], batch_size=2))
+        assert [uid for uid, _ in result] == [1, 2]
+
+    def test_propagates_fetch_errors(self):
+        """Test that an error on the fetch thread is raised to the consumer."""
+        imap = FakeBatchImap({1: b"x" * 200}, fail_after=1)
+        seen = []
+        with pytest.raises(OSError):
+            for uid, _ in iter_raw_messages(imap, [1, 2], batch_size=1):
+                seen.append(uid)
+        assert seen == [1]
+
+
+class FakeSearchImap:
+    """Stand-in for imaplib.IMAP4_SSL answering SELECT and UID SEARCH."""
+
+    def __init__(self, search_result):
+        self.search_result = search_result
+        self.searches = []
+
+    def select(self, mailbox, readonly=False):
+        return "OK", [b"1"]
+
+    def uid(self, command, charset, criteria):
+        self.searches.append(criteria)
+        return "OK", [self.search_result]
+
+
+class TestFetchNewUids:
+    """Tests for fetch_new_uids function."""
+
+    def test_searches_incremental_window_with_subject(self):
+        """Test that only UIDs above last_uid are searched, with the subject filter."""
+        imap = FakeSearchImap(b"11 12")
+        assert fetch_new_uids(imap, "INBOX", 10, subject_filter="Receipt") == [11, 12]
+        assert imap.searches == ['UID 11:* SUBJECT "Receipt"']
+
+    def test_merges_known_uids(self):
+        """Test that known UIDs are returned without being searched again."""
+        imap = FakeSearchImap(b"11")
+        assert fetch_new_uids(imap, "INBOX", 10, subject_filter="Receipt", known_uids=[7, 9]) == [7, 9, 11]
+
+    def test_ignores_newest_message_below_window(self):
+        """Test that the UID returned for "n:*" when nothing is newer is dropped."""
+        imap = FakeSearchImap(b"10")
+        assert fetch_new_uids(imap, "INBOX", 10, subject_filter="Receipt") == []
+
+
+class TestState:
+    """Tests for load_state and save_state functions."""
+
+    def test_round_trip(self, tmp_path):
+        """Test that saved state loads back."""
+        path = str(tmp_path / "state" / "last_uid.txt")
+        save_state(path, 42, [40, 38])
+        assert load_state(path) == (42, [38, 40])
+
+    def test_save_replaces_atomically(self, tmp_path):
+        """Test that saving overwrites the previous state and leaves no temp file behind."""
+        path = tmp_path / "last_uid.txt"
+        path.write_text("5", encoding="utf-8")
+        save_state(str(path), 9, [])
+        assert load_state(str(path)) == (9, [])
+        assert [p.name for p in tmp_path.iterdir()] == ["last_uid.txt"]
+
+    def test_missing_file(self, tmp_path):
+        """Test that a missing state file starts from scratch."""
+        assert load_state(str(tmp_path / "missing.txt")) == (0, [])
+
+    def test_legacy_plain_uid(self, tmp_path):
+        """Test that a legacy state file holding only the last UID is accepted."""
+        path = tmp_path / "last_uid.txt"
+        path.write_text("123\n", encoding="utf-8")
+        assert load_state(str(path)) == (123, [])
+
+
+class TestParseEmailToRow:
+    """Tests for parse_email_to_row function."""
+
+    def test_builds_row_in_csv_column_order(self):
+        """Test that a receipt email becomes a tuple row in CSV column order."""
+        msg = MIMEText("<p>SOURCE_GRABFOOD A-8Q34JAIGWGQMAV ฿ 296 ค่าอาหาร ฿ 260</p>", "html", "utf-8")
+        msg["Date"] = "Thu, 24 Apr 2025 05:26:59 +0000"
+        row = parse_email_to_row(7, msg)
+        assert tuple(row) == (
+            "7",
+            "2025-04-24T05:26:59+00:00",
+            "GrabFood",
+            "A-8Q34JAIGWGQMAV",
+            "THB",
+            "296.00",
+            '{"subtotal":260.0}',
+        )
+        assert list(row._fields) == CSV_FIELDNAMES
+
+
+class TestDumpMetadata:
+    """Tests for dump_metadata function."""
+
+    def test_compact_json_keeps_thai(self):
+        """Test compact JSON output with non-ASCII text kept as-is."""
+        assert dump_metadata({"restaurant": "ร้าน", "subtotal": 260.0}) == '{"restaurant":"ร้าน","subtotal":260.0}'
+
+    def test_empty_metadata(self):
+        """Test that empty metadata serializes to an empty string."""
+        assert dump_metadata({}) == ""
+
+
+class TestEnsureCsvWithHeader:
+    """Tests for ensure_csv_with_header function."""
+
+    def test_writes_header_once(self, tmp_path):
+        """Test that the header is written only when the file is new."""
+        path = str(tmp_path / "receipts.csv")
+        for uid in ("1", "2"):
+            writer, f = ensure_csv_with_header(path, ["uid", "type"])
+            writer.writerow((uid, "GrabFood"))
+            close_csv_writer(f)
+        with open(path, encoding="utf-8") as f:
+            assert f.read().splitlines() == ["uid,type", "1,GrabFood", "2,GrabFood"]
+
+
+class TestBuildArgParser:
+    """Tests for build_arg_parser function."""
+
+    def test_batch_size_default(self):
+        """Test the default batch size."""
+        assert build_arg_parser().parse_args([]).batch_size == 100
+
+    def test_batch_size_must_be_positive(self):
+        """Test that zero, negative and non-integer batch sizes are rejected."""
+        parser = build_arg_parser()
+        assert parser.parse_args(["--batch-size", "25"]).batch_size == 25
+        for value in ("0", "-5", "abc"):
+            with pytest.raises(SystemExit):
+                parser.parse_args(["--batch-size", value])